@@ -56,10 +56,8 @@ import sys
 import natsort
 import shutil
 from easydict import EasyDict as edict
-import operator
 import pint
 import time
-import operator
 
 from mpi4py import MPI
 comm = MPI.COMM_WORLD
@@ -230,6 +228,7 @@ md.comp = False #True / false
 md.maxIts=50
 md.perturb=1 # 0 for material heterogeneity, 1 for cohesion weakening
 md.pertSig=1. #sigma for gaussian filter
+md.saveFigs=True #set md.saveFigs=False to skip rendering the figures
 
 
 # In[6]:
@@ -319,6 +318,18 @@ ndp.rho = dp.rho/sf.rho
 ndp.notchWidth = dp.notchWidth/sf.LS
 ndp.a = dp.a
 ndp.lam=dp.lam/sf.eta0
+
+#derived geometric constants, used repeatedly when building the notch and locating the shear band
+#(plain floats, not stored in ndp so the params output is unchanged)
+_asthNotch = ndp.asthenosphere + ndp.notchWidth   #top of the notch
+_halfNotch = 0.5*ndp.notchWidth
+_twoSig2 = 2*(0.25*ndp.notchWidth)**2             #2 sigma^2 for the gaussian shoulders of the notch
+
+#the parameter dictionaries don't gain any keys after this point, so their sorted key order 
+#(used when writing params.csv) is fixed once here
+dpKeys = tuple(sorted(dp.keys()))
+ndpKeys = tuple(sorted(ndp.keys()))
+mdKeys = tuple(sorted(md.keys()))
             
 
 
@@ -375,10 +386,9 @@ allWalls = iWalls + jWalls
 velocityBCs = uw.conditions.DirichletCondition( variable        = velocityField, 
                                                 indexSetsPerDof = (iWalls, base) )
 
-for index in mesh.specialSets["MinI_VertexSet"]:
-    velocityField.data[index] = [ndp.U0, 0.]
-for index in mesh.specialSets["MaxI_VertexSet"]:
-    velocityField.data[index] = [ -ndp.U0, 0.]
+#set the wall velocities with one indexed assignment per wall (IndexSet.data holds the node indices)
+velocityField.data[mesh.specialSets["MinI_VertexSet"].data] = [ndp.U0, 0.]
+velocityField.data[mesh.specialSets["MaxI_VertexSet"].data] = [ -ndp.U0, 0.]
     
 
 
@@ -465,45 +475,36 @@ material2 = 2 # Under layer
 
 materialVariable.data[:] = 0.
 
-# The particle coordinates will be the input to the function evaluate (see final line in this cell).
+# The coordinates are the input to several of the functions below (e.g. the lithostatic pressure).
 # We get proxy for this now using the input() function.
 
 coord = fn.input()
 
-# Setup the conditions list for the following conditional function. Where the
-# z coordinate (coordinate[1]) is less than the perturbation, set to lightIndex.
-
-
+# Material layout: air above 1.0, and a weak under layer (asthenosphere) at the base, 
+# raised into a notch with gaussian shoulders at x = 0. These are simple functions of the 
+# coordinates, so the particles are classified directly with numpy rather than by evaluating
+# an underworld conditional function.
 
 #notchWidth = (1./32.) * md.notch_fac
 
-notchCond = operator.and_(coord[1] < ndp.asthenosphere + ndp.notchWidth, operator.and_(coord[0] < ndp.notchWidth, coord[0] > -1.*ndp.notchWidth )  )
-
-mu = ndp.notchWidth
-sig =  0.25*ndp.notchWidth
-gausFn1 = ndp.notchWidth*fn.math.exp(-1.*(coord[0] - mu)**2/(2 * sig**2)) + ndp.asthenosphere
-mu = -1.*ndp.notchWidth
-gausFn2 = ndp.notchWidth*fn.math.exp(-1.*(coord[0] - mu)**2/(2 * sig**2)) + ndp.asthenosphere
-
-conditions = [ (       coord[1] > 1.0 , material0 ), #air
-               (       coord[1] < ndp.asthenosphere , material2 ), #asthenosphere
-               (       coord[1] < gausFn1 , material2 ), #asthenosphere
-               (       coord[1] < gausFn2 , material2 ), #asthenosphere       
-
-               (       notchCond , material2 ),
-               (       True ,           material1 ) ]  #visco-plastic
-
-# The actual function evaluation. Here the conditional function is evaluated at the location
-# of each swarm particle. The results are then written to the materialVariable swarm variable.
-
 
 if md.perturb == 0:
-    materialVariable.data[:] = fn.branching.conditional( conditions ).evaluate(swarm)
-    
+    #Writes are applied from lowest to highest priority, so later writes win
+    x = np.ascontiguousarray(swarm.particleCoordinates.data[:,0])
+    y = np.ascontiguousarray(swarm.particleCoordinates.data[:,1])
+    gaus1 = ndp.notchWidth*np.exp(-1.*(x - ndp.notchWidth)**2/_twoSig2) + ndp.asthenosphere
+    gaus2 = ndp.notchWidth*np.exp(-1.*(x + ndp.notchWidth)**2/_twoSig2) + ndp.asthenosphere
+
+    matData = np.full(x.shape, material1, dtype=materialVariable.data.dtype)
+    matData[(y < _asthNotch) & (np.abs(x) < ndp.notchWidth)] = material2
+    matData[(y < ndp.asthenosphere) | (y < gaus1) | (y < gaus2)] = material2
+    matData[y > 1.0] = material0
+    materialVariable.data[:,0] = matData
+
 else: 
     #in this case just build the asphenosphere
     materialVariable.data[:] = material1
-    materialVariable.data[np.where(swarm.particleCoordinates.data[:,1] < ndp.asthenosphere)] = material2
+    materialVariable.data[swarm.particleCoordinates.data[:,1] < ndp.asthenosphere] = material2
     
     
 
@@ -549,20 +550,23 @@ lithPressureFn = ndp.rho* (1. - coord[1])
 #Create a filtered random signal on mesh
 
 #from scipy.ndimage.filters import gaussian_filter
-np.random.seed(22)
 randomField    = uw.mesh.MeshVariable( mesh=mesh, nodeDofCount=1 )
-randomField.data[:,0] = np.random.rand(randomField.data.shape[:][0])
+rng = np.random.RandomState(22) #own generator, same stream as np.random.seed(22) without touching the global state
+randomField.data[:,0] = rng.random_sample(randomField.data.shape[0])
 
 
 #this only works in serial atm
 if uw.nProcs()==1:
-    from scipy.ndimage.filters import gaussian_filter
+    from scipy.ndimage import gaussian_filter
 
-    rfdata = randomField.data.copy()
-    rfdata = rfdata.reshape(2*mesh.elementRes[1] + 1, 2*mesh.elementRes[0] + 1)
-    filt = gaussian_filter(rfdata,  sigma=md.pertSig)
-    #plt.imshow(filt)
-    randomField.data[:,0] = filt.reshape(randomField.data.shape[:][0])
+    #view the nodal values as the (2*resY + 1, 2*resX + 1) Q2 node grid. 
+    #Setting .shape (rather than reshape) raises if this would need a copy
+    rfdata = randomField.data[:,0]
+    rfdata.shape = (2*mesh.elementRes[1] + 1, 2*mesh.elementRes[0] + 1)
+    
+    #ndimage applies the (separable) gaussian one axis at a time, so it can filter straight into the field
+    gaussian_filter(rfdata,  sigma=md.pertSig, output=rfdata)
+    #plt.imshow(rfdata)
 
 
     #normalse the filterd signal
@@ -582,23 +586,70 @@ figPert.append( glucifer.objects.Mesh(mesh))
 
 # plastic strain - weaken a region at the base close to the boundary (a weak seed but through cohesion softening)
 
+# both helpers work in place on a single work array, rather than allocating a temporary per operation
+
 def gaussian(xx, centre, width):
-    return ( np.exp( -(xx - centre)**2 / width ))
+    gg = xx - centre
+    gg *= gg
+    gg *= -1./width
+    return np.exp(gg, out=gg)
 
 def boundary(xx, minX, maxX, width, power):
-    zz = (xx - minX) / (maxX - minX)
-    return (np.tanh(zz*width) + np.tanh((1.0-zz)*width) - math.tanh(width))**power
+    zw = xx - minX
+    zw *= width / (maxX - minX)     #zz*width, with zz the normalised coordinate
+    bb = np.tanh(width - zw)        #tanh((1-zz)*width)
+    bb += np.tanh(zw, out=zw)
+    bb -= math.tanh(width)
+    if power == 2:
+        bb *= bb                    #avoid the generic pow path for the common case
+        return bb
+    return bb**power
+
+def q2_interpolate(nodeValues, coords):
+    """
+    Interpolate a scalar Q2 nodal field (e.g. randomField.data[:,0]) at the points coords.
+    
+    This assumes the regular, undeformed cartesian mesh and the full node grid 
+    (i.e. serial, like the random field filter above): the element holding each point 
+    and its local coordinates then follow directly from the element spacing, 
+    so no mesh search is needed.
+    """
+    minC = np.array(mesh.minCoord)
+    res = np.array(mesh.elementRes)
+    h = (np.array(mesh.maxCoord) - minC)/res
+    nx = 2*res[0] + 1
+    
+    loc = (coords - minC)/h
+    el = np.clip(np.floor(loc).astype(int), 0, res - 1)
+    s = 2.*(loc - el) - 1.   #local coordinates, in [-1, 1]
+    
+    #quadratic Lagrange shape functions for the nodes at -1, 0, 1
+    Nx = (0.5*s[:,0]*(s[:,0] - 1.), 1. - s[:,0]**2, 0.5*s[:,0]*(s[:,0] + 1.))
+    Ny = (0.5*s[:,1]*(s[:,1] - 1.), 1. - s[:,1]**2, 0.5*s[:,1]*(s[:,1] + 1.))
+    
+    vals = np.zeros(coords.shape[0])
+    for b in range(3):
+        rowStart = (2*el[:,1] + b)*nx + 2*el[:,0]
+        for a in range(3):
+            vals += Nx[a]*Ny[b]*nodeValues[rowStart + a]
+    return vals
 
 # weight = boundary(swarm.particleCoordinates.data[:,1], 10, 4) 
 
 if md.perturb != 0: #build a heterogenity into the cohesion, through the accumulated plastic strain term
 
     #plasticStrain.data[:] = np.random.normal(loc=0.5, scale=0.05,size = plasticStrain.data.shape[:])
-    plasticStrain.data[:] = randomField.evaluate(swarm)*0.5
-    plasticStrain.data[:,0] *= gaussian(swarm.particleCoordinates.data[:,0], 0.0, ndp.notchWidth) 
-    plasticStrain.data[:,0] *= gaussian(swarm.particleCoordinates.data[:,1], ndp.asthenosphere, ndp.notchWidth/2.) 
-    plasticStrain.data[:,0] *= boundary(swarm.particleCoordinates.data[:,0], minX, maxX, 10.0, 2)
-    plasticStrain.data[:,0][np.where(swarm.particleCoordinates.data[:,1] < ndp.asthenosphere)] = 0.
+    x = np.ascontiguousarray(swarm.particleCoordinates.data[:,0])
+    y = np.ascontiguousarray(swarm.particleCoordinates.data[:,1])
+
+    #build the seed in a single work array, and write it to the swarm variable once
+    if uw.nProcs()==1:
+        ps = q2_interpolate(randomField.data[:,0], swarm.particleCoordinates.data)*0.5
+    else:
+        ps = randomField.evaluate(swarm)[:,0]*0.5
+    ps *= gaussian(x, 0.0, ndp.notchWidth)*gaussian(y, ndp.asthenosphere, _halfNotch)*boundary(x, minX, maxX, 10.0, 2)
+    ps[y < ndp.asthenosphere] = 0.
+    plasticStrain.data[:,0] = ps
 
 # 
 
@@ -609,7 +660,7 @@ if md.perturb != 0: #build a heterogenity into the cohesion, through the accumul
 figMat2 = glucifer.Figure( figsize=(1200,400), boundingBox=((-2.0, 0.0, 0.0), (2.0, 1.0, 0.0)) )
 figMat2.append( glucifer.objects.Points(swarm,plasticStrain, pointSize=2.0) )
 figMat2.append( glucifer.objects.Mesh(mesh))
-figMat2.show()
+#figMat2.show()
 
 
 # In[23]:
@@ -697,6 +748,13 @@ solver = uw.systems.Solver( stokes )
 solver.set_inner_method("mumps")
 if md.pen and not md.comp:          #if lambda is set, no penalty should be used
     solver.set_penalty(md.pen) 
+
+#The matrix sparsity is the same for every Picard solve, and PETSc keeps the MUMPS analysis 
+#(ordering + symbolic factorisation) between solves, so only the numerical factorisation is redone. 
+#In parallel, also let MUMPS run that analysis across the ranks rather than on one.
+if uw.nProcs() > 1:
+    solver.options.A11.mat_mumps_icntl_28 = 2 #parallel analysis
+    solver.options.A11.mat_mumps_icntl_29 = 0 #automatic choice of the parallel ordering tool
 solver.options.scr.ksp_rtol = 1.0e-7
 solver.options.scr.ksp_rtol = 1.0e-4
 
@@ -728,10 +786,23 @@ prevPressureField.data[:] = 0.
 def volumeint(Fn = 1., rFn=1.):
     return uw.utils.Integral( Fn*rFn,  mesh )
 
+def vectorfn(*fns):
+    """
+    Pack a number of scalar functions into a single vector function (component i is fns[i]), 
+    so that they can be integrated / evaluated together in one pass over the mesh or swarm.
+    """
+    packed = None
+    for i, f in enumerate(fns):
+        unit = np.zeros(len(fns))
+        unit[i] = 1.
+        term = f*fn.misc.constant(tuple(unit))
+        packed = term if packed is None else packed + term
+    return packed
+
 
 # In[30]:
 
-md.maxIts = 10.
+md.maxIts = 10
 
 
 # In[31]:
@@ -754,6 +825,19 @@ surfacePressureIntegral = uw.utils.Integral(fn=pressureField, mesh=mesh, integra
 
 
 
+#The norm integrals only hold references to the fields, so they are built once
+#and simply re-evaluated each iteration. All the squared norms are packed into one
+#vector integrand, so a single mesh sweep gives them all
+
+delV = velocityField - prevVelocityField
+delP = pressureField - prevPressureField
+
+_normsInt = volumeint(vectorfn(fn.math.dot(velocityField,  velocityField),     #L2 norm of current velocity
+                               fn.math.dot(delV,  delV),                       #L2 norm of delta velocity
+                               fn.math.dot(pressureField, pressureField),      #L2 norm of current dynamic pressure
+                               fn.math.dot(delP,  delP)))                      #L2 norm of delta dynamic pressure
+
+
 count = 0
 
 
@@ -761,7 +845,7 @@ res1Vals = []
 res2Vals = []
 res3Vals = []
 
-for i in range(int(md.maxIts)):
+for i in range(md.maxIts):
     
     prevVelocityField.data[:] = velocityField.data.copy()
     prevPressureField.data[:] = pressureField.data[:] 
@@ -781,45 +865,16 @@ for i in range(int(md.maxIts)):
     #Caluclate a range of norms to assess convergence
     ####
     
-    #L2 norm of current velocity
-    v2 = fn.math.dot(velocityField,  velocityField)
-    _Vr = volumeint(v2)
-    velL2 = np.sqrt(_Vr.evaluate()[0])
-    
-    
-    #L2 norm of delta velocity
-    
-    delV = velocityField - prevVelocityField
-    v2 = fn.math.dot(delV,  delV)
-    _Vr = volumeint(v2)
-    delvelL2 = np.sqrt(_Vr.evaluate()[0])
-    
-    
-    #L2 norm of current dynamic pressure
-    p2 = fn.math.dot(pressureField, pressureField)
-    _Pr = volumeint(p2)
-    pL2 = np.sqrt(_Pr.evaluate()[0])
-    
-    
-    #L2 norm of delta dynamic pressure
-    delP = pressureField - prevPressureField
-    p2 = fn.math.dot(delP,  delP)
-    _Pr = volumeint(p2)
-    delpL2 = np.sqrt(_Pr.evaluate()[0])
-    
-    #Full norm of the primal variables
-    
-    x2 = fn.math.dot(velocityField,  velocityField) + fn.math.dot(pressureField, pressureField)
-    _Xr = volumeint(x2)
-    xL2 = np.sqrt(_Xr.evaluate()[0])
+    (v2, delv2, p2, delp2) = _normsInt.evaluate()
     
-    #Full norm of the change in primal variables
+    velL2 = np.sqrt(v2)
+    delvelL2 = np.sqrt(delv2)
+    pL2 = np.sqrt(p2)
+    delpL2 = np.sqrt(delp2)
     
-    delV = velocityField - prevVelocityField
-    delP = pressureField - prevPressureField
-    x2 = fn.math.dot(delV,  delV) + fn.math.dot(delP, delP)
-    _Xr = volumeint(x2)
-    delxL2 = np.sqrt(_Xr.evaluate()[0])
+    #Full norms of the primal variables, and of their change
+    xL2 = np.sqrt(v2 + p2)
+    delxL2 = np.sqrt(delv2 + delp2)
     
     
     
@@ -926,9 +981,10 @@ figPres.append( glucifer.objects.Points(swarm, pressureField,pointSize=2.0, valu
 
 # In[158]:
 
-#figSinv.save_image(imagePath + "figSinv.png")
-figVisc.save_image(imagePath +  "figVisc.png")
-figPres.save_image(imagePath + "figPres.png")
+if md.saveFigs:
+    #figSinv.save_image(imagePath + "figSinv.png")
+    figVisc.save_image(imagePath +  "figVisc.png")
+    figPres.save_image(imagePath + "figPres.png")
 
 
 # In[159]:
@@ -958,13 +1014,6 @@ eii_std = uw.utils.Integral(fn.math.sqrt(0.25*(strainRate_2ndInvariantFn - eii_m
 
 
 
-xv, yv = np.meshgrid(
-        np.linspace(mesh.minCoord[0], mesh.maxCoord[0], mesh.elementRes[0]), 
-        np.linspace(mesh.minCoord[1], mesh.maxCoord[1], mesh.elementRes[1]))
-
-meshGlobs = np.row_stack((xv.flatten(), yv.flatten())).T
-
-
 #Calculate the 2-sigma value of the strain rate invariant function (
 #we use this a definition for a shear band)
 eII_sig = eii_mean  + 1.5*eii_std
@@ -973,7 +1022,7 @@ eII_sig = eii_mean  + 1.5*eii_std
 # In[179]:
 
 shearbandswarm  = uw.swarm.Swarm( mesh=mesh, particleEscape=True )
-shearbandswarmlayout  = uw.swarm.layouts.GlobalSpaceFillerLayout( swarm=shearbandswarm , particlesPerCell=int(md.ppc/16.) )
+shearbandswarmlayout  = uw.swarm.layouts.GlobalSpaceFillerLayout( swarm=shearbandswarm , particlesPerCell=int(md.ppc)//16 )
 shearbandswarm.populate_using_layout( layout=shearbandswarmlayout )
 
 
@@ -984,7 +1033,8 @@ shearbandswarm.populate_using_layout( layout=shearbandswarmlayout )
 
 # In[181]:
 
-np.unique(strainRate_2ndInvariantFn.evaluate(shearbandswarm) < eII_sig)
+#strain rate invariant at the shear band points. Evaluated once and reused for the filtering below
+srinv = strainRate_2ndInvariantFn.evaluate(shearbandswarm)[:,0]
 
 
 # In[11]:
@@ -994,28 +1044,21 @@ np.unique(strainRate_2ndInvariantFn.evaluate(shearbandswarm) < eII_sig)
 
 # In[166]:
 
-with shearbandswarm.deform_swarm():
-    mask = np.where(strainRate_2ndInvariantFn.evaluate(shearbandswarm) < eII_sig)
-    shearbandswarm.particleCoordinates.data[mask[0]]= (1e20, 1e20)
-
-shearbandswarm.update_particle_owners()    
+#remove all particles outside the shear band in one pass (one update of the particle owners):
+#those below the 2-sigma strain rate, near the top / base, and away from the left-hand band
 
 with shearbandswarm.deform_swarm():
-    mask = np.where((shearbandswarm.particleCoordinates.data[:,1] < ndp.asthenosphere + ndp.notchWidth) | 
-                    (shearbandswarm.particleCoordinates.data[:,1] >  1. - ndp.notchWidth) |
-                    (shearbandswarm.particleCoordinates.data[:,0] <  minX/1.5))
-    shearbandswarm.particleCoordinates.data[mask]= (1e20, 1e20)
+    sbCoords = shearbandswarm.particleCoordinates.data
+    x = np.ascontiguousarray(sbCoords[:,0])
+    y = np.ascontiguousarray(sbCoords[:,1])
+    mask = ((srinv < eII_sig) | 
+            (y < _asthNotch) | (y >  1. - ndp.notchWidth) | 
+            (x <  minX/1.5) | (x > -2.*ndp.notchWidth))
+    sbCoords[mask]= (1e20, 1e20)
 
 shearbandswarm.update_particle_owners()
 
 
-with shearbandswarm.deform_swarm():
-    mask = np.where(shearbandswarm.particleCoordinates.data[:,0] > -2.*ndp.notchWidth)
-    shearbandswarm.particleCoordinates.data[mask]= (1e20, 1e20)
-                    
-shearbandswarm.update_particle_owners()
-
-
 # In[167]:
 
 shearbandswarm.save(filePath + 'swarm.h5')
@@ -1033,55 +1076,51 @@ shearbandswarm.save(filePath + 'swarm.h5')
 #We'll create a function that based on the strain rate 2-sigma value. 
 #Use this to estimate thickness and average pressure within the shear band
 
-conds = [ ( (strainRate_2ndInvariantFn >  eII_sig) & (coord[1] > ndp.asthenosphere + ndp.notchWidth), 1.),
-            (                                           True , 0.) ]
-
+#Both indicators come from one conditional, as a 2-vector: (in shear band, above the notch).
+#Above the top of the notch, the point is in the shear band if the strain rate is above the 2-sigma value.
+#The background (above the notch, outside the band) is the difference of the two, so its
+#integrals are found by subtraction rather than integrating a third indicator.
 
-conds2 = [ ( (strainRate_2ndInvariantFn <  eII_sig) & (coord[1] > ndp.asthenosphere + ndp.notchWidth), 1.),
-            (                                           True , 0.) ]
+bandConds = [ ( coord[1] <= _asthNotch,                   (0., 0.)),
+              ( strainRate_2ndInvariantFn >  eII_sig,     (1., 1.)),
+              (                                True ,     (0., 1.)) ]
 
+_bandMasks = fn.branching.conditional( bandConds )
 
 # lets also integrate just one eighth of sphere surface
-_2sigRest= fn.branching.conditional( conds ) 
+_2sigRest = _bandMasks[0]
 
-_out2sigRest= fn.branching.conditional( conds2 ) 
+_aboveNotch = _bandMasks[1]
 
 
 # In[169]:
 
+#note that rmsint is the integral of the speed |v| (not an rms velocity) - this is the metric used 
+#downstream, so the per point sqrt has to stay
 sqrtv2 = fn.math.sqrt(fn.math.dot(velocityField,velocityField))
 #sqrtv2x = fn.math.sqrt(fn.math.dot(velocityField[0],velocityField[0]))
 vd = 4.*viscosityFn*strainRate_2ndInvariantFn # there's an extra factor of 2, which is necessary because the of factor of 0.5 in the UW second invariant 
 
 
-_rmsint = uw.utils.Integral(sqrtv2, mesh)
-
 #_rmsSurf = uw.utils.Integral(sqrtv2x, mesh, integrationType='Surface',surfaceIndexSet=mesh.specialSets["MaxJ_VertexSet"])
 
-_viscMM = fn.view.min_max(viscosityFn)
-dummyFn = _viscMM.evaluate(swarm)
-
-_eiiMM = fn.view.min_max(strainRate_2ndInvariantFn)
-dummyFn = _eiiMM.evaluate(swarm)
-
-#Area and pressure integrals inside / outside shear band
-
-_shearArea = uw.utils.Integral(_2sigRest, mesh)
-_shearPressure = uw.utils.Integral(_2sigRest*pressureField, mesh)
-
-_backgroundArea = uw.utils.Integral(_out2sigRest, mesh)
-_backgroundPressure = uw.utils.Integral(_out2sigRest*pressureField, mesh)
+#viscosity, strain rate invariant and (dynamic) pressure, evaluated together on the swarm 
+#to get their min / max
 
-#dissipation 
+_statsFn = vectorfn(viscosityFn, strainRate_2ndInvariantFn, pressureField)
 
-_vdint  = uw.utils.Integral(vd,mesh)
-_shearVd  = uw.utils.Integral(vd*_2sigRest,mesh)
-_backgroundVd  = uw.utils.Integral(vd*_out2sigRest,mesh)
+#Integrated speed, area and pressure integrals inside / outside shear band, and the dissipation,
+#packed into one vector integral so they are computed in a single pass over the mesh
 
-#dynamic pressure min / max
-
-_press = fn.view.min_max(pressureField)
-dummyFn = _press.evaluate(swarm)
+_bandInt = uw.utils.Integral(vectorfn(sqrtv2,                      #integrated speed
+                                      _2sigRest,                   #shear band area
+                                      _2sigRest*pressureField,     #shear band pressure
+                                      _aboveNotch,                 #area above the notch
+                                      _aboveNotch*pressureField,   #pressure above the notch
+                                      vd,                          #dissipation 
+                                      vd*_2sigRest,                #shear band dissipation
+                                      vd*_aboveNotch),             #dissipation above the notch
+                             mesh)
 
 
 # In[ ]:
@@ -1091,29 +1130,28 @@ dummyFn = _press.evaluate(swarm)
 
 # In[170]:
 
-#_viscMM.min_global(), _viscMM.max_global()
-#_eiiMM.min_global(), _eiiMM.max_global()
-
-rmsint = _rmsint.evaluate()[0]
-
-shearArea = _shearArea.evaluate()[0]
-shearPressure = _shearPressure.evaluate()[0]
-
-backgroundArea = _backgroundArea.evaluate()[0]
-backgroundPressure = _backgroundPressure.evaluate()[0]
+(rmsint, 
+ shearArea, shearPressure, 
+ aboveArea, abovePressure, 
+ vdint, shearVd, aboveVd) = _bandInt.evaluate()
 
-vdint = _vdint.evaluate()[0]
-shearVd = _shearVd.evaluate()[0]
-backgroundVd = _backgroundVd.evaluate()[0]
+#background = above the notch, but outside the shear band
+backgroundArea = aboveArea - shearArea
+backgroundPressure = abovePressure - shearPressure
+backgroundVd = aboveVd - shearVd
 
 
-viscmin = _viscMM.min_global()
-viscmax = _viscMM.max_global()
-eiimin = _eiiMM.min_global()
-eiimax = _eiiMM.max_global()
+#one pass over the swarm, then a single reduction for all the extrema (the max are negated, so MIN gives both)
+statVals = _statsFn.evaluate(swarm)
+localExt = np.full(6, np.inf)
+if statVals.shape[0]:
+    localExt[:3] = statVals.min(axis=0)
+    localExt[3:] = -statVals.max(axis=0)
+globalExt = np.empty(6)
+comm.Allreduce(localExt, globalExt, op=MPI.MIN)
 
-pressmax = _press.max_global()
-pressmin = _press.min_global()
+(viscmin, eiimin, pressmin) = globalExt[:3]
+(viscmax, eiimax, pressmax) = -globalExt[3:]
 
 
 # ## scratch
@@ -1125,44 +1163,51 @@ import h5py
 
 # In[172]:
 
+def fit_line(x, y):
+    """
+    least squares straight line y = slope*x + intercept
+    (the closed form of np.polyfit(x, y, 1), without the Vandermonde matrix / lstsq)
+    """
+    xm = x.mean()
+    ym = y.mean()
+    dx = x - xm
+    slope = np.dot(dx, y - ym)/np.dot(dx, dx)
+    return slope, ym - slope*xm
+
+
 fname = filePath + 'swarm.h5'
 
 if uw.rank()==0:
     with h5py.File(fname,'r') as hf:
         #print('List of arrays in this file: \n', hf.keys())
-        data = hf.get('data')
-        np_data = np.array(data)
-
-    sbx =  np_data[:,0]
-    sby =  np_data[:,1]
+        #read just the two coordinate columns straight from the dataset
+        data = hf['data']
+        sbx =  data[:,0]
+        sby =  data[:,1]
 
     #sbx =  shearbandswarm.particleCoordinates.data[:,0]
     #sby =  shearbandswarm.particleCoordinates.data[:,1]
 
-    z = np.polyfit(sbx, sby, 1)
-    p = np.poly1d(z)
+    #least squares straight line through the shear band points 
+    dydx, const = fit_line(sbx, sby)
     
-    #newcoords = np.column_stack((sbx, p(sbx)))
-    angle = math.atan(z[0])*(180./math.pi)
+    #newcoords = np.column_stack((sbx, dydx*sbx + const))
+    angle = math.degrees(math.atan(dydx))
     45. - dp.fa
     
-comm.barrier()
 
 
 
-
-if rank==0:
-    dydx = p[1]
-    const = p[0]
-else:
+if rank!=0:
     dydx = 1.
     const = 0.
+    angle = 0.
 
-# share value of dydx
-comm.barrier()
-dydx = comm.bcast(dydx, root = 0)
-const = comm.bcast(const, root = 0)
-comm.barrier()
+# share the line (and its angle) with all procs. The broadcast itself synchronises, so no barriers are needed, 
+# and the values travel in one message (as a raw float64 buffer, so nothing is pickled)
+lineBuf = np.array([dydx, const, angle], dtype=np.float64)
+comm.Bcast(lineBuf, root = 0)
+(dydx, const, angle) = (float(lineBuf[0]), float(lineBuf[1]), float(lineBuf[2]))
 
 
 
@@ -1171,50 +1216,68 @@ print(dydx, const)
 
 # In[ ]:
 
-xs = np.linspace(0, -1., 100)
-newcoords = np.column_stack((xs, dydx*xs + const )) 
+#points along the fitted line, filled straight into the (100, 2) coordinate array
+newcoords = np.empty((100, 2))
+newcoords[:,0] = np.linspace(0, -1., 100)
+np.multiply(newcoords[:,0], dydx, out=newcoords[:,1])
+newcoords[:,1] += const
 
 
+#only hand this proc the points inside the bounding box of its part of the mesh (mesh.data includes 
+#the shadow nodes, so the box covers all local elements), the rest would be rejected by the point location anyway
+localMin = mesh.data.min(axis=0)
+localMax = mesh.data.max(axis=0)
+localMask = np.all((newcoords >= localMin) & (newcoords <= localMax), axis=1)
+
 swarmCustom = uw.swarm.Swarm(mesh)
-swarmCustom.add_particles_with_coordinates(newcoords )
+swarmCustom.add_particles_with_coordinates(np.ascontiguousarray(newcoords[localMask]))
 
 
 # In[177]:
 
-figTest2 = glucifer.Figure( figsize=(1600,400), boundingBox=((-2.0, 0.0, 0.0), (2.0, 1.0, 0.0)) )
-figTest2.append( glucifer.objects.Points(shearbandswarm, pointSize=2.0, colourBar=False) )
+#the figure is only built if it is going to be saved 
+if md.saveFigs:
+    figTest2 = glucifer.Figure( figsize=(1600,400), boundingBox=((-2.0, 0.0, 0.0), (2.0, 1.0, 0.0)) )
+    figTest2.append( glucifer.objects.Points(shearbandswarm, pointSize=2.0, colourBar=False) )
 
-figTest2.append( glucifer.objects.Points(swarmCustom , pointSize=4.0,colourBar=False) )
+    figTest2.append( glucifer.objects.Points(swarmCustom , pointSize=4.0,colourBar=False) )
 
-figTest2.append( glucifer.objects.Points(swarm,strainRate_2ndInvariantFn, pointSize=3.0, valueRange=[1e-3, 1.5]) )
+    figTest2.append( glucifer.objects.Points(swarm,strainRate_2ndInvariantFn, pointSize=3.0, valueRange=[1e-3, 1.5]) )
 
-#figTest2.show()
+    #figTest2.show()
 
-figTest2.save_image(imagePath +  "figTest2.png")
+    figTest2.save_image(imagePath +  "figTest2.png")
 
 
 # In[212]:
 
 import csv
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 if uw.rank()==0:
 
     someVals = [rmsint, shearArea ,shearPressure, 
                 backgroundArea, backgroundPressure, viscmin, viscmax, eiimin, eiimax, angle,vdint, shearVd, backgroundVd, pressmin, pressmax  ] 
 
+    #the metrics are a single fixed row of floats, formatted and written directly
     with open(os.path.join(outputPath, 'metrics.csv'), 'w') as csvfile:
-        writer = csv.writer(csvfile, delimiter=",")
-        writer.writerow(someVals)
-    with open(os.path.join(outputPath, 'solver.csv'), 'w') as csvfile:
-        writer = csv.writer(csvfile, delimiter=",")
-        writer.writerow(res1Vals)
-        writer.writerow(res2Vals)
-        writer.writerow(res3Vals)
+        csvfile.write(','.join('{:.17g}'.format(val) for val in someVals) + '\n')
+        
+    #the residuals are all floats (and the three lists have one entry per iteration), 
+    #so they go out as a 2-d array in one call
+    np.savetxt(os.path.join(outputPath, 'solver.csv'), np.array([res1Vals, res2Vals, res3Vals], dtype=float), delimiter=",", fmt='%.17g')
+    #the params are mixed types (and may be any string from the command line), so they still go through 
+    #csv.writer for its formatting and quoting, but into an in-memory buffer that is written in a single call
+    buf = StringIO()
+    writer = csv.writer(buf, delimiter=",")
+    writer.writerow([dp[i] for i in dpKeys]) #this makes sure the params are written in order of the sorted keys (i.e an order we can reproduce)
+    writer.writerow([ndp[i] for i in ndpKeys])
+    writer.writerow([md[i] for i in mdKeys])
     with open(os.path.join(outputPath, 'params.csv'), 'w') as csvfile:
-        writer = csv.writer(csvfile, delimiter=",")
-        writer.writerow([dp[i] for i in sorted(dp.keys())]) #this makes sure the params are written in order of the sorted keys (i.e an order we can reproduce)
-        writer.writerow([ndp[i] for i in sorted(ndp.keys())])
-        writer.writerow([md[i] for i in sorted(md.keys())])
+        csvfile.write(buf.getvalue())
 
 
 # test = np.array([0.5, 0.5])
@@ -56,10 +56,8 @@ import sys
 import natsort
 import shutil
 from easydict import EasyDict as edict
-import operator
 import pint
 import time
-import operator
 
 from mpi4py import MPI
 comm = MPI.COMM_WORLD
@@ -111,12 +109,18 @@ def nn_evaluation(fromSwarm, toSwarm, n=1, weighted=False):
     if len(toSwarm) > 0: #this is required for safety in parallel
         
         #this should avoid building the tree again when this function is called multiple times.
-        try:
+        #The tree is tagged with the coordinate buffer address, the particle count and the coordinate sum, 
+        #so it is rebuilt if the particles have been reallocated, added / removed, or moved in place (advection)
+        coords = fromSwarm.particleCoordinates.data
+        tag = (coords.ctypes.data, coords.shape[0], coords.sum())
+        if getattr(fromSwarm, '_treeTag', None) == tag:
             tree = fromSwarm.tree
-            #print(1)
-        except:
-            #print(2)
-            fromSwarm.tree = kdTree(fromSwarm.particleCoordinates.data)
+        else:
+            #the tree is rebuilt whenever the swarm changes, so favour a fast build (midpoint splits, 
+            #bigger leaves) over slightly faster queries
+            fromSwarm.tree = kdTree(coords, leafsize=32, 
+                                    balanced_tree=False, compact_nodes=False)
+            fromSwarm._treeTag = tag
             tree = fromSwarm.tree
         d, ix = tree.query(toSwarm, n)
         if n == 1:
@@ -124,7 +128,9 @@ def nn_evaluation(fromSwarm, toSwarm, n=1, weighted=False):
         elif not weighted:
             weights = np.ones((toSwarm.shape[0], n))*(1./n)
         else:
-            weights = (1./d[:])/(1./d[:]).sum(axis=1)[:,None]
+            #one reciprocal, normalised in place (the floor on d guards coincident points)
+            weights = 1./np.maximum(d, 1e-300)
+            weights /= weights.sum(axis=1, keepdims=True)
         return ix,  weights 
     else:
         return [], []
@@ -175,17 +181,15 @@ dbPath = outputPath + 'gldbs/'
 outputFile = 'results_model' + Model + '_' + str(ModNum) + '.dat'
 
 if uw.rank()==0:
-    # make directories if they don't exist
-    if not os.path.isdir(outputPath):
-        os.makedirs(outputPath)
-    if not os.path.isdir(checkpointPath):
-        os.makedirs(checkpointPath)
-    if not os.path.isdir(imagePath):
-        os.makedirs(imagePath)
-    if not os.path.isdir(dbPath):
-        os.makedirs(dbPath)
-    if not os.path.isdir(filePath):
-        os.makedirs(filePath)
+    # make directories if they don't exist. outputPath is the parent of the others, so makedirs creates it 
+    # along with the first of them. Just try to create each one (no stat up front), 
+    # an error is only raised if the path still isn't a directory (python 2 has no exist_ok)
+    for path in (checkpointPath, imagePath, dbPath, filePath):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
 
         
 comm.Barrier() #Barrier here so no procs run the check in the next cell too early
@@ -257,6 +261,7 @@ md.perturb=0 # 0 for material heterogeneity, 1 for cohesion weakening
 md.directorPhi=45. #if this is , angle is same as maximum shear 
 md.directorV=1e-5 #if this is false , angle is taken as tan(fa) / 2.
 md.directorSigma=1e-5 #standard deviation in fault orientation
+md.saveFigs=True #set md.saveFigs=False to skip rendering the figures
 
 
 # In[8]:
@@ -348,6 +353,11 @@ ndp.rho = dp.rho/sf.rho
 ndp.notchWidth = dp.notchWidth/sf.LS
 ndp.a = dp.a
 
+#derived geometric constant, used when building the notch and locating the shear band
+#(a plain float, not stored in ndp so the params output is unchanged)
+_asthNotch = ndp.asthenosphere + ndp.notchWidth   #top of the notch
+_sentinel = np.array([1e20, 1e20])                #far away coordinate, used to remove swarm particles
+
 
 
 ndp.fa, ndp.cohesion
@@ -405,10 +415,8 @@ allWalls = iWalls + jWalls
 velocityBCs = uw.conditions.DirichletCondition( variable        = velocityField, 
                                                 indexSetsPerDof = (iWalls, base) )
 
-for index in mesh.specialSets["MinI_VertexSet"]:
-    velocityField.data[index] = [ndp.U0, 0.]
-for index in mesh.specialSets["MaxI_VertexSet"]:
-    velocityField.data[index] = [ -ndp.U0, 0.]
+velocityField.data[mesh.specialSets["MinI_VertexSet"].data] = [ndp.U0, 0.]
+velocityField.data[mesh.specialSets["MaxI_VertexSet"].data] = [ -ndp.U0, 0.]
     
 
 
@@ -466,9 +474,7 @@ plasticStrain  = swarm.add_variable( dataType="double",  count=1 )
 
 # passive markers at the surface
 
-surfacePoints = np.zeros((1000,2))
-surfacePoints[:,0] = np.linspace(minX+0.01, maxX-0.01, 1000)
-surfacePoints[:,1] = 1.0 #
+surfacePoints = np.column_stack((np.linspace(minX+0.01, maxX-0.01, 1000), np.ones(1000)))
 
 surfaceSwarm.add_particles_with_coordinates( surfacePoints )
 yvelsurfVar = surfaceSwarm.add_variable( dataType="double", count=1)
@@ -499,39 +505,30 @@ material2 = 2 # Under layer
 
 materialVariable.data[:] = 0.
 
-# The particle coordinates will be the input to the function evaluate (see final line in this cell).
+# The coordinates are the input to several of the functions below (e.g. the lithostatic pressure).
 # We get proxy for this now using the input() function.
 
 coord = fn.input()
 
-# Setup the conditions list for the following conditional function. Where the
-# z coordinate (coordinate[1]) is less than the perturbation, set to lightIndex.
-
-
+# Material layout: air above 1.0, and a weak under layer (asthenosphere) at the base, 
+# raised into a notch with gaussian shoulders at x = 0. These are simple functions of the 
+# coordinates, so the particles are classified directly with numpy (np.select, first match wins) 
+# rather than by evaluating an underworld conditional function.
 
 #notchWidth = (1./32.) * md.notch_fac
 
-notchCond = operator.and_(coord[1] < ndp.asthenosphere + ndp.notchWidth, operator.and_(coord[0] < ndp.notchWidth, coord[0] > -1.*ndp.notchWidth )  )
-
-mu = ndp.notchWidth
-sig =  0.25*ndp.notchWidth
-gausFn1 = ndp.notchWidth*fn.math.exp(-1.*(coord[0] - mu)**2/(2 * sig**2)) + ndp.asthenosphere
-mu = -1.*ndp.notchWidth
-gausFn2 = ndp.notchWidth*fn.math.exp(-1.*(coord[0] - mu)**2/(2 * sig**2)) + ndp.asthenosphere
-
-conditions = [ (       coord[1] > 1.0 , material0 ), #air
-               (       coord[1] < ndp.asthenosphere , material2 ), #asthenosphere
-               (       coord[1] < gausFn1 , material2 ), #asthenosphere
-               (       coord[1] < gausFn2 , material2 ), #asthenosphere       
-
-               (       notchCond , material2 ),
-               (       True ,           material1 ) ]  #visco-plastic
-
-# The actual function evaluation. Here the conditional function is evaluated at the location
-# of each swarm particle. The results are then written to the materialVariable swarm variable.
-
 if md.perturb == 0:
-    materialVariable.data[:] = fn.branching.conditional( conditions ).evaluate(swarm)
+    x = np.ascontiguousarray(swarm.particleCoordinates.data[:,0])
+    y = np.ascontiguousarray(swarm.particleCoordinates.data[:,1])
+    sig =  0.25*ndp.notchWidth
+    gaus1 = ndp.notchWidth*np.exp(-1.*(x - ndp.notchWidth)**2/(2 * sig**2)) + ndp.asthenosphere
+    gaus2 = ndp.notchWidth*np.exp(-1.*(x + ndp.notchWidth)**2/(2 * sig**2)) + ndp.asthenosphere
+    notch = (y < _asthNotch) & (np.abs(x) < ndp.notchWidth)
+    
+    materialVariable.data[:,0] = np.select([y > 1.0,                                                    #air
+                                            (y < ndp.asthenosphere) | (y < gaus1) | (y < gaus2) | notch], #asthenosphere
+                                           [material0, material2], 
+                                           default=material1)                                          #visco-plastic
     
 else: 
     #in this case just build the asphenosphere
@@ -607,10 +604,7 @@ yieldStressFn   = weakenedCohesion  + ndp.fa *(lithPressureFn + ndp.a*pressureFi
 #yieldStressFn   = cohesionFn + ndp.fa *(lithPressureFn + ndp.a*fn.misc.max(fn.misc.constant(0.), pressureField) ) #in this case only positive dynamic pressures
 
 
-# first define strain rate tensor
-
-strainRateFn = fn.tensor.symmetric( velocityField.fn_gradient )
-strainRate_2ndInvariantFn = fn.tensor.second_invariant(strainRateFn)
+# the strain rate tensor and its invariant are the ones defined with the background rheology (In[19])
 
 # now compute a viscosity assuming yielding
 
@@ -666,7 +660,7 @@ solver.solve(nonLinearIterate=True, nonLinearMaxIterations=1)
 
 # In[25]:
 
-strainRateFn = fn.tensor.symmetric( velocityField.fn_gradient )
+#strainRateFn (In[19]) refers to the velocity field, so it already sees this solution
 LFn = velocityField.fn_gradient 
 
 
@@ -694,17 +688,28 @@ eig2  = swarm.add_variable( dataType="double",  count=2 )
 
 ssr = strainRateFn.evaluate(swarm)
 
-for ti, val in enumerate(eig1.data):
-    eigVals, eigVex= np.linalg.eig(np.array([[ssr[ti][0],ssr[ti][2]],[ssr[ti][2],ssr[ti][1]]]))
-    pi = np.argmin(eigVals) #index of largest eigenvalue
-    eig1.data[ti] = eigVex[pi]
-    eig2.data[ti] = eigVex[abs(pi - 1)] #index of other eigenvalue - 2D assumption
+#stack the 2x2 strain rate tensors of all particles, and solve them in one batched eig call
+ssrMats = np.empty((ssr.shape[0], 2, 2))
+ssrMats[:,0,0] = ssr[:,0]
+ssrMats[:,1,1] = ssr[:,1]
+ssrMats[:,0,1] = ssr[:,2]
+ssrMats[:,1,0] = ssr[:,2]
+
+if ssr.shape[0]:
+    eigVals, eigVex = np.linalg.eig(ssrMats)
+    pi = np.argmin(eigVals, axis=1) #index of largest eigenvalue
+    rows = np.arange(ssr.shape[0])
+    eig1.data[:] = eigVex[rows, pi]
+    eig2.data[:] = eigVex[rows, 1 - pi] #index of other eigenvalue - 2D assumption
     
 
 
 # In[27]:
 
-principalAngles = np.degrees(np.arctan(eig1.data[:,1]/(eig1.data[:,0] + 1e-20)))
+#angle of the eigenvector, folded into (-90, 90] (the eigenvector sign is arbitrary): flipping the vector 
+#into the x >= 0 half plane lets arctan2 do this without the division (and its 1e-20 guard)
+flip = np.where(eig1.data[:,0] < 0., -1., 1.)
+principalAngles = np.degrees(np.arctan2(flip*eig1.data[:,1], flip*eig1.data[:,0]))
 
 
 # ## Director Vector for TI rheology
@@ -713,19 +718,16 @@ principalAngles = np.degrees(np.arctan(eig1.data[:,1]/(eig1.data[:,0] + 1e-20)))
 
 aOrient = principalAngles + (45. - dp.fa/2.)
 bOrient = principalAngles - (45. - dp.fa/2.)
-finalOrient = np.zeros(aOrient.shape)
 
 
 # In[29]:
 
-an = np.zeros((aOrient.shape[0], 2))
-bn = np.zeros((bOrient.shape[0], 2))
+#unit normals of the two candidate slip planes (angles converted to radians once each)
+aRad = np.radians(aOrient)
+bRad = np.radians(bOrient)
 
-an[:,0] = np.cos(np.radians(aOrient))
-an[:,1] = np.sin(np.radians(aOrient))
-#                           
-bn[:,0] = np.cos(np.radians(bOrient))
-bn[:,1] = np.sin(np.radians(bOrient))
+an = np.column_stack((np.cos(aRad), np.sin(aRad)))
+bn = np.column_stack((np.cos(bRad), np.sin(bRad)))
 
 
 # In[30]:
@@ -738,8 +740,8 @@ Lij = LFn.evaluate(swarm)
 #define the matrix product for $\dot n_i = L_{ji} n_j$
 
 def Ldotn(L,n):
-    x,y =  L[:,0]*n[:,0] + L[:,1]*n[:,1], L[:,2]*n[:,0] + L[:,3]*n[:,1]
-    return np.column_stack((x, y))
+    #the rows of L are the flattened 2x2 gradients ([L00, L01, L10, L11]), so reshape (no copy) and contract
+    return np.einsum('nij,nj->ni', L.reshape(-1, 2, 2), n)
 
 
 # In[32]:
@@ -756,21 +758,22 @@ bAction = Ldotn(Lij,bn)
 
 amask = np.linalg.norm(aAction, axis=1) < np.linalg.norm(bAction, axis=1)
 
-finalOrient[:] = bOrient[:]
-finalOrient[amask] = aOrient[amask]
+finalOrient = np.where(amask, aOrient, bOrient)
 
 
 # In[34]:
 
 #in this step we find the normal vector to the shear band
-directorVector.data[:,0] = np.sin(np.radians(finalOrient))
-directorVector.data[:,1] = -1.*np.cos(np.radians(finalOrient))
+finalRad = np.radians(finalOrient)
+directorVector.data[:,0] = np.sin(finalRad)
+directorVector.data[:,1] = -1.*np.cos(finalRad)
 
 
 # In[35]:
 
-principleStress.data[:,0] = np.cos(np.radians(principalAngles))
-principleStress.data[:,1] = np.sin(np.radians(principalAngles))
+principalRad = np.radians(principalAngles)
+principleStress.data[:,0] = np.cos(principalRad)
+principleStress.data[:,1] = np.sin(principalRad)
 
 
 # In[36]:
@@ -804,10 +807,13 @@ principleStress.data[:,1] = np.sin(np.radians(principalAngles))
 ix, weights = nn_evaluation(swarm, mesh.data, n=1, weighted=False)
 
 meshDirector = uw.mesh.MeshVariable( mesh, mesh.dim )
-meshDirector.data[:] = directorVector.data[ix]
-
 sigma1= uw.mesh.MeshVariable( mesh, mesh.dim )
-sigma1.data[:] = principleStress.data[ix]
+
+#gather the nearest particle values straight into the mesh variables (no intermediate array). 
+#The indices come from the tree so they are in range, and mode='clip' avoids numpy buffering the output
+if len(ix):
+    np.take(directorVector.data, ix, axis=0, out=meshDirector.data, mode='clip')
+    np.take(principleStress.data, ix, axis=0, out=sigma1.data, mode='clip')
 
 
 #eigAngle= uw.mesh.MeshVariable( mesh, mesh.dim )
@@ -945,6 +951,19 @@ prevPressureField.data[:] = 0.
 def volumeint(Fn = 1., rFn=1.):
     return uw.utils.Integral( Fn*rFn,  mesh )
 
+def vectorfn(*fns):
+    """
+    Pack a number of scalar functions into a single vector function (component i is fns[i]), 
+    so that they can be integrated / evaluated together in one pass over the mesh or swarm.
+    """
+    packed = None
+    for i, f in enumerate(fns):
+        unit = np.zeros(len(fns))
+        unit[i] = 1.
+        term = f*fn.misc.constant(tuple(unit))
+        packed = term if packed is None else packed + term
+    return packed
+
 
 # In[51]:
 
@@ -971,6 +990,19 @@ surfacePressureIntegral = uw.utils.Integral(fn=pressureField, mesh=mesh, integra
 
 
 
+#The norm integral is built once, it references the fields so each evaluate() sees the current solution.
+#The four squared norms are packed into one vector integral (one pass over the mesh), 
+#the full norms are sums of these, so they don't need integrals of their own
+
+delV = velocityField - prevVelocityField
+delP = pressureField - prevPressureField
+
+_normsInt = volumeint(vectorfn(fn.math.dot(velocityField,  velocityField),     #L2 norm of current velocity
+                               fn.math.dot(delV,  delV),                       #L2 norm of delta velocity
+                               fn.math.dot(pressureField, pressureField),      #L2 norm of current dynamic pressure
+                               fn.math.dot(delP,  delP)))                      #L2 norm of delta dynamic pressure
+
+
 count = 0
 
 
@@ -998,45 +1030,16 @@ for i in range(int(md.maxIts)):
     #Calculate a range of norms to assess convergence
     ####
     
-    #L2 norm of current velocity
-    v2 = fn.math.dot(velocityField,  velocityField)
-    _Vr = volumeint(v2)
-    velL2 = np.sqrt(_Vr.evaluate()[0])
-    
-    
-    #L2 norm of delta velocity
-    
-    delV = velocityField - prevVelocityField
-    v2 = fn.math.dot(delV,  delV)
-    _Vr = volumeint(v2)
-    delvelL2 = np.sqrt(_Vr.evaluate()[0])
-    
-    
-    #L2 norm of current dynamic pressure
-    p2 = fn.math.dot(pressureField, pressureField)
-    _Pr = volumeint(p2)
-    pL2 = np.sqrt(_Pr.evaluate()[0])
+    (v2, delv2, p2, delp2) = _normsInt.evaluate()
     
+    velL2 = np.sqrt(v2)
+    delvelL2 = np.sqrt(delv2)
+    pL2 = np.sqrt(p2)
+    delpL2 = np.sqrt(delp2)
     
-    #L2 norm of delta dynamic pressure
-    delP = pressureField - prevPressureField
-    p2 = fn.math.dot(delP,  delP)
-    _Pr = volumeint(p2)
-    delpL2 = np.sqrt(_Pr.evaluate()[0])
-    
-    #Full norm of the primal variables
-    
-    x2 = fn.math.dot(velocityField,  velocityField) + fn.math.dot(pressureField, pressureField)
-    _Xr = volumeint(x2)
-    xL2 = np.sqrt(_Xr.evaluate()[0])
-    
-    #Full norm of the change in primal variables
-    
-    delV = velocityField - prevVelocityField
-    delP = pressureField - prevPressureField
-    x2 = fn.math.dot(delV,  delV) + fn.math.dot(delP, delP)
-    _Xr = volumeint(x2)
-    delxL2 = np.sqrt(_Xr.evaluate()[0])
+    #Full norms of the primal variables, and of their change
+    xL2 = np.sqrt(v2 + p2)
+    delxL2 = np.sqrt(delv2 + delp2)
     
     
     
@@ -1124,11 +1127,12 @@ figPres.append( glucifer.objects.Points(swarm, pressureField,pointSize=2.0, valu
 
 # In[127]:
 
-figSinv.save_image(imagePath + "figSinv.png")
+if md.saveFigs:
+    figSinv.save_image(imagePath + "figSinv.png")
 
-figVisc.save_image(imagePath +  "figVisc.png")
+    figVisc.save_image(imagePath +  "figVisc.png")
 
-figPres.save_image(imagePath + "figPres.png")
+    figPres.save_image(imagePath + "figPres.png")
 
 
 # In[128]:
@@ -1158,13 +1162,6 @@ eii_std = uw.utils.Integral(fn.math.sqrt(0.25*(strainRate_2ndInvariantFn - eii_m
 
 
 
-xv, yv = np.meshgrid(
-        np.linspace(mesh.minCoord[0], mesh.maxCoord[0], mesh.elementRes[0]), 
-        np.linspace(mesh.minCoord[1], mesh.maxCoord[1], mesh.elementRes[1]))
-
-meshGlobs = np.row_stack((xv.flatten(), yv.flatten())).T
-
-
 #Calculate the 2-sigma value of the strain rate invariant function (
 #we use this a definition for a shear band)
 eII_sig = eii_mean  + 1.5*eii_std
@@ -1182,31 +1179,25 @@ shearbandswarm.populate_using_layout( layout=shearbandswarmlayout )
 #shearbandswarm.particleGlobalCount
 
 
-# In[179]:
-
-np.unique(strainRate_2ndInvariantFn.evaluate(shearbandswarm) < eII_sig)
-
-
 # In[180]:
 
-with shearbandswarm.deform_swarm():
-    mask = np.where(strainRate_2ndInvariantFn.evaluate(shearbandswarm) < eII_sig)
-    shearbandswarm.particleCoordinates.data[mask[0]]= (1e20, 1e20)
-
-shearbandswarm.update_particle_owners()    
+#remove (send far away) the particles outside the shear band: below the 2-sigma strain rate, 
+#in the notch / under layer, near the top, and outside the window on the left side of the notch. 
+#All the tests are made on the same (undeformed) coordinates, so they are combined into one mask, 
+#with one deform and a single ownership update
 
-with shearbandswarm.deform_swarm():
-    mask = np.where((shearbandswarm.particleCoordinates.data[:,1] < ndp.asthenosphere + ndp.notchWidth) | 
-                    (shearbandswarm.particleCoordinates.data[:,1] >  1. - ndp.notchWidth) |
-                   (shearbandswarm.particleCoordinates.data[:,0] <  minX/1.5))
-    shearbandswarm.particleCoordinates.data[mask]= (1e20, 1e20)
-
-shearbandswarm.update_particle_owners()
+eiiVals = strainRate_2ndInvariantFn.evaluate(shearbandswarm)[:,0]
+sbCoords = shearbandswarm.particleCoordinates.data
 
+#the mask is accumulated in place, so there is one boolean buffer rather than a new one per |
+mask = eiiVals < eII_sig
+mask |= sbCoords[:,1] < _asthNotch
+mask |= sbCoords[:,1] >  1. - ndp.notchWidth
+mask |= sbCoords[:,0] <  minX/1.5
+mask |= sbCoords[:,0] > -2.*ndp.notchWidth
 
 with shearbandswarm.deform_swarm():
-    mask = np.where(shearbandswarm.particleCoordinates.data[:,0] > -2.*ndp.notchWidth)
-    shearbandswarm.particleCoordinates.data[mask]= (1e20, 1e20)
+    shearbandswarm.particleCoordinates.data[mask]= _sentinel
                     
 shearbandswarm.update_particle_owners()
 
@@ -1224,18 +1215,21 @@ shearbandswarm.save(filePath + 'swarm.h5')
 #We'll create a function that based on the strain rate 2-sigma value. 
 #Use this to estimate thickness and average pressure within the shear band
 
-conds = [ ( (strainRate_2ndInvariantFn >  eII_sig) & (coord[1] > ndp.asthenosphere + ndp.notchWidth), 1.),
-            (                                           True , 0.) ]
+#Both indicators come from one conditional, as a 2-vector: (in shear band, above the notch).
+#Above the top of the notch, the point is in the shear band if the strain rate is above the 2-sigma value.
+#The background (above the notch, outside the band) is the difference of the two, so its
+#integrals are found by subtraction rather than integrating a third indicator.
 
+bandConds = [ ( coord[1] <= _asthNotch,                   (0., 0.)),
+              ( strainRate_2ndInvariantFn >  eII_sig,     (1., 1.)),
+              (                                True ,     (0., 1.)) ]
 
-conds2 = [ ( (strainRate_2ndInvariantFn <  eII_sig) & (coord[1] > ndp.asthenosphere + ndp.notchWidth), 1.),
-            (                                           True , 0.) ]
-
+_bandMasks = fn.branching.conditional( bandConds )
 
 # lets also integrate just one eighth of sphere surface
-_2sigRest= fn.branching.conditional( conds ) 
+_2sigRest = _bandMasks[0]
 
-_out2sigRest= fn.branching.conditional( conds2 ) 
+_aboveNotch = _bandMasks[1]
 
 
 # In[183]:
@@ -1249,31 +1243,27 @@ _rmsint = uw.utils.Integral(sqrtv2, mesh)
 
 #_rmsSurf = uw.utils.Integral(sqrtv2x, mesh, integrationType='Surface',surfaceIndexSet=mesh.specialSets["MaxJ_VertexSet"])
 
-_viscMM = fn.view.min_max(backgroundViscosityFn)
-dummyFn = _viscMM.evaluate(swarm)
-
-_eiiMM = fn.view.min_max(strainRate_2ndInvariantFn)
-dummyFn = _eiiMM.evaluate(swarm)
-
-#Area and pressure integrals inside / outside shear band
-_shearArea = uw.utils.Integral(_2sigRest, mesh)
-_shearPressure = uw.utils.Integral(_2sigRest*pressureField, mesh)
+#viscosity, strain rate invariant and (dynamic) pressure, evaluated together on the swarm 
+#to get their min / max
 
-_backgroundArea = uw.utils.Integral(_out2sigRest, mesh)
-_backgroundPressure = uw.utils.Integral(_out2sigRest*pressureField, mesh)
+_statsFn = vectorfn(backgroundViscosityFn, strainRate_2ndInvariantFn, pressureField)
 
-#dissipation 
+#Area and pressure integrals inside / outside shear band, and the dissipation,
+#packed into one vector integral so they are computed in a single pass over the mesh
 
-_vdint  = uw.utils.Integral(vd,mesh)
-_shearVd  = uw.utils.Integral(vd*_2sigRest,mesh)
-_backgroundVd  = uw.utils.Integral(vd*_out2sigRest,mesh)
+_bandInt = uw.utils.Integral(vectorfn(_2sigRest,                   #shear band area
+                                      _2sigRest*pressureField,     #shear band pressure
+                                      _aboveNotch,                 #area above the notch
+                                      _aboveNotch*pressureField,   #pressure above the notch
+                                      vd,                          #dissipation 
+                                      vd*_2sigRest,                #shear band dissipation
+                                      vd*_aboveNotch),             #dissipation above the notch
+                             mesh)
 
 
 #dynamic pressure min / max
 
 #dynPressureField.data[:] = pressureField.data[:] - lithPressureFn.evaluate(mesh.subMesh)
-_press = fn.view.min_max(pressureField)
-dummyFn = _press.evaluate(swarm)
 
 
 # In[ ]:
@@ -1288,24 +1278,27 @@ dummyFn = _press.evaluate(swarm)
 
 rmsint = _rmsint.evaluate()[0]
 
-shearArea = _shearArea.evaluate()[0]
-shearPressure = _shearPressure.evaluate()[0]
+(shearArea, shearPressure, 
+ aboveArea, abovePressure, 
+ vdint, shearVd, aboveVd) = _bandInt.evaluate()
 
-backgroundArea = _backgroundArea.evaluate()[0]
-backgroundPressure = _backgroundPressure.evaluate()[0]
+#background = above the notch, but outside the shear band
+backgroundArea = aboveArea - shearArea
+backgroundPressure = abovePressure - shearPressure
+backgroundVd = aboveVd - shearVd
 
-vdint = _vdint.evaluate()[0]
-shearVd = _shearVd.evaluate()[0]
-backgroundVd = _backgroundVd.evaluate()[0]
 
+#one pass over the swarm, then a single reduction for all the extrema (the max are negated, so MIN gives both)
+statVals = _statsFn.evaluate(swarm)
+localExt = np.full(6, np.inf)
+if statVals.shape[0]:
+    localExt[:3] = statVals.min(axis=0)
+    localExt[3:] = -statVals.max(axis=0)
+globalExt = np.empty(6)
+comm.Allreduce(localExt, globalExt, op=MPI.MIN)
 
-viscmin = _viscMM.min_global()
-viscmax = _viscMM.max_global()
-eiimin = _eiiMM.min_global()
-eiimax = _eiiMM.max_global()
-
-pressmax = _press.max_global()
-pressmin = _press.min_global()
+(viscmin, eiimin, pressmin) = globalExt[:3]
+(viscmax, eiimax, pressmax) = -globalExt[3:]
 
 
 # In[ ]:
@@ -1316,51 +1309,52 @@ pressmin = _press.min_global()
 # 
 # ## scratch
 
-# In[185]:
-
-import h5py
+# In[186]:
 
+def fit_line(x, y):
+    """
+    least squares straight line y = slope*x + intercept
+    (the closed form of np.polyfit(x, y, 1), without the Vandermonde matrix / lstsq)
+    """
+    xm = x.mean()
+    ym = y.mean()
+    dx = x - xm
+    slope = np.dot(dx, y - ym)/np.dot(dx, dx)
+    return slope, ym - slope*xm
 
-# In[186]:
 
-fname = filePath + 'swarm.h5'
+#collect the shear band particle coordinates on rank 0 straight from memory, 
+#rather than reading back the swarm.h5 file that was just written 
+#(particles sent away in the deform step have escaped, the check on x just makes sure)
+sbLocal = shearbandswarm.particleCoordinates.data
+sbLocal = sbLocal[sbLocal[:,0] < 1e19]
+sbAll = comm.gather(sbLocal, root=0)
 
 if uw.rank()==0:
-    with h5py.File(fname,'r') as hf:
-        #print('List of arrays in this file: \n', hf.keys())
-        data = hf.get('data')
-        np_data = np.array(data)
+    np_data = np.vstack(sbAll)
 
     sbx =  np_data[:,0]
     sby =  np_data[:,1]
 
-    #sbx =  shearbandswarm.particleCoordinates.data[:,0]
-    #sby =  shearbandswarm.particleCoordinates.data[:,1]
-
-    z = np.polyfit(sbx, sby, 1)
-    p = np.poly1d(z)
+    #least squares straight line through the shear band points 
+    dydx, const = fit_line(sbx, sby)
     
-    #newcoords = np.column_stack((sbx, p(sbx)))
-    angle = math.atan(z[0])*(180./math.pi)
+    #newcoords = np.column_stack((sbx, dydx*sbx + const))
+    angle = math.degrees(math.atan(dydx))
     45. - dp.fa
     
-comm.barrier()
-
 
 
 
-if rank==0:
-    dydx = p[1]
-    const = p[0]
-else:
+if rank!=0:
     dydx = 1.
     const = 0.
 
-# share value of dydx
-comm.barrier()
-dydx = comm.bcast(dydx, root = 0)
-const = comm.bcast(const, root = 0)
-comm.barrier()
+# share the line with all procs. The broadcast itself synchronises, so no barriers are needed, 
+# and both values travel in one message (as a raw float64 buffer, so nothing is pickled)
+lineBuf = np.array([dydx, const], dtype=np.float64)
+comm.Bcast(lineBuf, root = 0)
+(dydx, const) = (float(lineBuf[0]), float(lineBuf[1]))
 
 
 
@@ -1369,27 +1363,20 @@ print(dydx, const)
 
 # In[187]:
 
-xs = np.linspace(0, -1., 100)
-newcoords = np.column_stack((xs, dydx*xs + const )) 
+#points along the fitted line, filled straight into a contiguous (100, 2) float64 coordinate array
+newcoords = np.empty((100, 2))
+newcoords[:,0] = np.linspace(0, -1., 100)
+np.multiply(newcoords[:,0], dydx, out=newcoords[:,1])
+newcoords[:,1] += const
 
+#only hand this proc the points inside the bounding box of its part of the mesh (mesh.data includes 
+#the shadow nodes, so the box covers all local elements), the rest would be rejected by the point location anyway
+localMin = mesh.data.min(axis=0)
+localMax = mesh.data.max(axis=0)
+localMask = np.all((newcoords >= localMin) & (newcoords <= localMax), axis=1)
 
 swarmCustom = uw.swarm.Swarm(mesh)
-swarmCustom.add_particles_with_coordinates(newcoords )
-
-
-# In[188]:
-
-figTest2 = glucifer.Figure( figsize=(1600,400), boundingBox=((-2.0, 0.0, 0.0), (2.0, 1.0, 0.0)) )
-figTest2.append( glucifer.objects.Points(shearbandswarm, pointSize=2.0, colourBar=False) )
-
-figTest2.append( glucifer.objects.Points(swarmCustom , pointSize=4.0,colourBar=False) )
-
-figTest2.append( glucifer.objects.Points(swarm,strainRate_2ndInvariantFn, pointSize=3.0, valueRange=[1e-3, 2.]) )
-
-
-#figTest2.show()
-
-figTest2.save_image(imagePath +  "figTest2.png")
+swarmCustom.add_particles_with_coordinates(np.ascontiguousarray(newcoords[localMask]))
 
 
 # In[ ]:
@@ -1403,17 +1390,13 @@ import csv
 
 if uw.rank()==0:
 
-    someVals = [rmsint, shearArea ,shearPressure, 
-                backgroundArea, backgroundPressure, viscmin, viscmax, eiimin, eiimax, angle,vdint, shearVd, backgroundVd, pressmin, pressmax  ] 
+    someVals = np.array([rmsint, shearArea ,shearPressure, 
+                         backgroundArea, backgroundPressure, viscmin, viscmax, eiimin, eiimax, angle,vdint, shearVd, backgroundVd, pressmin, pressmax  ], dtype=np.float64) 
 
-    with open(os.path.join(outputPath, 'metrics.csv'), 'w') as csvfile:
-        writer = csv.writer(csvfile, delimiter=",")
-        writer.writerow(someVals)
-    with open(os.path.join(outputPath, 'solver.csv'), 'w') as csvfile:
-        writer = csv.writer(csvfile, delimiter=",")
-        writer.writerow(res1Vals)
-        writer.writerow(res2Vals)
-        writer.writerow(res3Vals)
+    #the metrics and the residuals are all floats (and the three residual lists have one entry per iteration), 
+    #so they go out as 2-d arrays in one call each
+    np.savetxt(os.path.join(outputPath, 'metrics.csv'), someVals[None,:], delimiter=",", fmt='%.17g')
+    np.savetxt(os.path.join(outputPath, 'solver.csv'), np.array([res1Vals, res2Vals, res3Vals], dtype=float), delimiter=",", fmt='%.17g')
     with open(os.path.join(outputPath, 'params.csv'), 'w') as csvfile:
         writer = csv.writer(csvfile, delimiter=",")
         writer.writerow([dp[i] for i in sorted(dp.keys())]) #this makes sure the params are written in order of the sorted keys (i.e an order we can reproduce)
@@ -1421,6 +1404,24 @@ if uw.rank()==0:
         writer.writerow([md[i] for i in sorted(md.keys())])
 
 
+# In[188]:
+
+#the figure is only built if it is going to be saved. It is rendered last, after the metrics are written, 
+#so the results are on disk even if the (collective) rendering is slow or fails
+if md.saveFigs:
+    figTest2 = glucifer.Figure( figsize=(1600,400), boundingBox=((-2.0, 0.0, 0.0), (2.0, 1.0, 0.0)) )
+    figTest2.append( glucifer.objects.Points(shearbandswarm, pointSize=2.0, colourBar=False) )
+
+    figTest2.append( glucifer.objects.Points(swarmCustom , pointSize=4.0,colourBar=False) )
+
+    figTest2.append( glucifer.objects.Points(swarm,strainRate_2ndInvariantFn, pointSize=3.0, valueRange=[1e-3, 2.]) )
+
+
+    #figTest2.show()
+
+    figTest2.save_image(imagePath +  "figTest2.png")
+
+
 # test = np.array([0.5, 0.5])
 # 
 # ys = np.linspace(0, 1, 10)